@@ -0,0 +1,75 @@
+import hashlib
+import os
+import tempfile
+
+import bz3
+
+
+# file contents, stored under the sha256 of their bytes so that identical files are only kept once
+# blobs that got smaller when compressed are stored that way instead, with .bz3 on the end of their name
+ROOT = "blobs"
+COMPRESSED = ".bz3"
+# compressed blobs have to be decompressed whole to be served, so ones bigger than this are always left as they are
+COMPRESS_LIMIT = 1024 * 1024
+
+def path(hash):
+    return os.path.join(ROOT, hash[:2], hash[2:])
+
+def find(hash):
+    p = path(hash)
+    if os.path.exists(p + COMPRESSED):
+        return p + COMPRESSED
+    return p
+
+def write(p, data):
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    # written elsewhere first, so nobody can see half of a blob
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(p), delete=False) as f:
+        f.write(data)
+    os.replace(f.name, p)
+
+def put(content):
+    hash = hashlib.sha256(content).hexdigest()
+    p = path(hash)
+    if not os.path.exists(p) and not os.path.exists(p + COMPRESSED):
+        if len(content) <= COMPRESS_LIMIT and len(compressed := bz3.compress(content)) < len(content):
+            write(p + COMPRESSED, compressed)
+        else:
+            write(p, content)
+    return hash
+
+def get(hash):
+    p = find(hash)
+    with open(p, "rb") as f:
+        data = f.read()
+    return bz3.decompress(data) if p.endswith(COMPRESSED) else data
+
+def compress(hash):
+    # for blobs written before they were compressed, or before big ones were left uncompressed
+    p = path(hash)
+    if os.path.exists(p + COMPRESSED):
+        with open(p + COMPRESSED, "rb") as f:
+            content = bz3.decompress(f.read())
+        if len(content) > COMPRESS_LIMIT:
+            write(p, content)
+            os.remove(p + COMPRESSED)
+        return
+    if not os.path.exists(p):
+        return
+    with open(p, "rb") as f:
+        content = f.read()
+    if len(content) > COMPRESS_LIMIT:
+        return
+    compressed = bz3.compress(content)
+    if len(compressed) < len(content):
+        write(p + COMPRESSED, compressed)
+        os.remove(p)
+
+def hashes():
+    if not os.path.isdir(ROOT):
+        return
+    for d in os.listdir(ROOT):
+        for name in os.listdir(os.path.join(ROOT, d)):
+            name = name.removesuffix(COMPRESSED)
+            if len(d + name) == 64:
+                yield d + name
@@ -0,0 +1,125 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+
+# one pooled session per worker, so connections to Canon are kept alive between requests
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.canon_pool_size)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+# for making several lookups at once
+pool = ThreadPoolExecutor(max_workers=config.canon_pool_size)
+
+# "METHOD /path/{id}" -> [calls, failures, total seconds, slowest call in seconds]
+latencies = {}
+latencies_lock = threading.Lock()
+
+# circuit breaker: after enough failed or slow calls in a row, stop calling Canon for a while
+consecutive_failures = 0
+opened_at = None
+breaker_lock = threading.Lock()
+
+class Unavailable(Exception):
+    pass
+
+def breaker_open():
+    with breaker_lock:
+        return opened_at is not None and time.monotonic() - opened_at < config.canon_breaker_cooldown
+
+def note_result(ok):
+    global consecutive_failures, opened_at
+    with breaker_lock:
+        if ok:
+            consecutive_failures = 0
+            opened_at = None
+            return
+        consecutive_failures += 1
+        if consecutive_failures >= config.canon_breaker_failures:
+            # also restarts the cooldown if a trial call failed after the last one ran out
+            opened_at = time.monotonic()
+
+def endpoint(method, path):
+    return f"{method} " + re.sub(r"/-?\d+", "/{id}", path)
+
+def record(method, path, elapsed, failed):
+    with latencies_lock:
+        stats = latencies.setdefault(endpoint(method, path), [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += failed
+        stats[2] += elapsed
+        stats[3] = max(stats[3], elapsed)
+
+def request(method, path, **kwargs):
+    if breaker_open():
+        raise Unavailable(f"not calling {endpoint(method, path)}: circuit open")
+    kwargs.setdefault("timeout", config.canon_timeout)
+    start = time.perf_counter()
+    try:
+        r = session.request(method, config.canon_url + path, **kwargs)
+    except requests.RequestException as e:
+        record(method, path, time.perf_counter() - start, True)
+        note_result(False)
+        raise Unavailable(f"{endpoint(method, path)} failed: {e}") from e
+    elapsed = time.perf_counter() - start
+    failed = r.status_code >= 500
+    record(method, path, elapsed, failed)
+    note_result(not failed and elapsed < config.canon_slow)
+    if failed:
+        raise Unavailable(f"{endpoint(method, path)} failed: status {r.status_code}")
+    return r
+
+def get(path, **kwargs):
+    return request("GET", path, **kwargs)
+
+def post(path, **kwargs):
+    return request("POST", path, **kwargs)
+
+def patch(path, **kwargs):
+    return request("PATCH", path, **kwargs)
+
+def delete(path, **kwargs):
+    return request("DELETE", path, **kwargs)
+
+
+# a size-bounded LRU cache of answers from Canon that go stale after `ttl` seconds
+# stale answers are kept until evicted, so they can still be shown when Canon is unavailable
+class TTLCache:
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # returns (value, fresh), or None if nothing is known about key
+    def get(self, key):
+        with self.lock:
+            try:
+                value, at = self.entries[key]
+            except KeyError:
+                return None
+            self.entries.move_to_end(key)
+            return value, time.monotonic() - at < self.ttl
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value, time.monotonic()
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,39 +1,53 @@
 import sys
 import datetime
 import io
+import gzip
+import contextlib
 import itertools
 import os
 import re
 import random
 import hashlib
 import shutil
+import sqlite3
 import html
 import tarfile
+import tempfile
 import zipfile
 import json
 import logging
 import importlib
-from collections import defaultdict
+import multiprocessing
+import time
+import threading
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from urllib.parse import quote
 from pathlib import PurePosixPath
 
+import bz3
 import nh3
+import click
 import charset_normalizer
 import magic
 import mistune
 import requests
 import flask
 import flask_discord
+import pygments
 import yarl
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import wrap_file
 from oauthlib import oauth2
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
 from pygments.formatters import HtmlFormatter
 from pygments.util import ClassNotFound
 
+import blobs
+import canon
 import config
-from db import connect
+from db import connect, Pool
 
 
 logging.basicConfig(filename=config.log_file, encoding="utf-8", format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s", level=logging.INFO)
@@ -52,23 +66,56 @@ plugins = ["strikethrough", "table", "footnotes"]
 markdown = mistune.create_markdown(plugins=plugins)
 markdown_html = mistune.create_markdown(escape=False, plugins=plugins)
 formatter = HtmlFormatter(linenos=True)
+# part of the key of every cached display, so bump it when render_display changes
+RENDERER = f"cg 1, pygments {pygments.__version__}"
+
+def pages_version():
+    # round pages are made by this file with the config in effect, so changing either makes them stale
+    h = hashlib.sha256(RENDERER.encode())
+    for path in __file__, config.__file__:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# part of the key of every cached round page
+PAGES = pages_version()
 style = formatter.get_style_defs(".code")
 
 
+readers = Pool(config.db_pool_size, readonly=True)
+writers = Pool(config.db_pool_size)
+
+def only_reading():
+    # GETs only read, apart from the odd cache write, which goes through get_writer()
+    # who knows what extra modules do
+    return flask.has_request_context() and flask.request.method in ("GET", "HEAD") and flask.request.endpoint != "load_extra_module"
+
 def get_db():
     try:
         return flask.g._db
     except AttributeError:
-        db = connect()
+        pool = readers if only_reading() else writers
+        db = pool.get()
         flask.g._db = db
+        flask.g._db_pool = pool
         return db
 
-@app.teardown_appcontext
-def close_connection(exception):
+def get_writer():
+    if not only_reading():
+        return get_db()
     try:
-        flask.g._db.close()
+        return flask.g._writer
     except AttributeError:
-        pass
+        db = writers.get()
+        flask.g._writer = db
+        return db
+
+@app.teardown_appcontext
+def close_connection(exception):
+    if db := flask.g.pop("_db", None):
+        flask.g.pop("_db_pool").put(db)
+    if db := flask.g.pop("_writer", None):
+        writers.put(db)
 
 
 @app.route("/")
@@ -88,7 +135,12 @@ def get_summary(spec):
     return l[0].replace("*", "") if l else None
 
 def join_warning(user_id):
-    if user_id and not can_play(user_id):
+    try:
+        playing = not user_id or can_play(user_id)
+    except canon.Unavailable:
+        # the degraded notice already says we can't tell
+        return ""
+    if not playing:
         return f'<aside>note: you are not on <a href="{config.invite_link}">the Discord server</a>. joining it is a requirement to play.</aside>'
     return ""
 
@@ -97,6 +149,8 @@ def index():
     nums = get_db().execute("SELECT num, started_at, spec, stage FROM Rounds ORDER BY num DESC").fetchall()
     rounds = "".join(f"<li><a href='/{n}/'>round #{n}</a> ({get_title(spec)})</li>" if stage else f"<li>round #{n} at {format_time(start)}</li>" for n, start, spec, stage in nums)
     user_id = fetch_user_id()
+    admin = is_admin(user_id)
+    warning = join_warning(user_id)
     return f"""
 <!DOCTYPE html>
 <html>
@@ -114,23 +168,68 @@ def index():
       &bull; <a href="/info">info</a>
       &bull; <a href="/credits">credits</a>
       &bull; <a href="/anon">anon settings</a>
-      {f' &bull; <a href="/admin/">admin panel</a>'*is_admin(user_id)}
+      {f' &bull; <a href="/admin/">admin panel</a>'*admin}
       {f' &bull; <a href="/logout">log out</a>'*bool(user_id)}
     </p>
-    {join_warning(user_id)}
+    {degraded_notice()}
+    {warning}
     <ul>{rounds}</ul>
   </body>
 </html>
 """
 
+def send_blob(hash, name):
+    path = blobs.find(hash)
+    # compressed blobs have to be decompressed whole, but blobs.put never compresses big ones
+    source = io.BytesIO(blobs.get(hash)) if path.endswith(blobs.COMPRESSED) else os.path.abspath(path)
+    return flask.send_file(source, mimetype="application/octet-stream", download_name=PurePosixPath(name).name, etag=hash)
+
+# files can't change once a round leaves stage 1
+FILE_MAX_AGE = 365 * 24 * 60 * 60
+
 @app.route("/<int:num>/<path:name>")
 def download_file(num, name):
     user_id = fetch_user_id()
-    f = get_db().execute("SELECT Files.content FROM Files INNER JOIN Rounds ON Rounds.num = Files.round_num "
+    f = get_db().execute("SELECT Files.rowid, Files.hash, Rounds.stage FROM Files INNER JOIN Rounds ON Rounds.num = Files.round_num "
                          "WHERE Files.round_num = ? AND Files.name = ? AND (Rounds.stage <> 1 OR Files.author_id = ?)", (num, name, user_id)).fetchone()
     if not f:
         flask.abort(404)
-    resp = flask.send_file(io.BytesIO(f[0]), mimetype="application/octet-stream")
+    if f["hash"]:
+        resp = send_blob(f["hash"], name)
+    else:
+        # not in the blob store yet, so stream it straight out of the database
+        # this outlives the request, so it needs its own connection
+        db = connect()
+        try:
+            blob = db.blobopen("Files", "content", f["rowid"], readonly=True)
+            resp = flask.Response(wrap_file(flask.request.environ, blob), mimetype="application/octet-stream", direct_passthrough=True)
+            resp.content_length = len(blob)
+            # raises for a Range that can't be satisfied, and then nothing will ever close the response
+            resp.make_conditional(flask.request, accept_ranges=True, complete_length=len(blob))
+        except Exception:
+            db.close()
+            raise
+        resp.call_on_close(db.close)
+    if f["stage"] == 1:
+        # only its author can see it, and they can still replace it
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+    else:
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = FILE_MAX_AGE
+    return resp
+
+@app.route("/the.db")
+def download_public_db():
+    if "gzip" in flask.request.accept_encodings and os.path.exists("static/the.db.gz"):
+        resp = flask.send_file(os.path.abspath("static/the.db.gz"), mimetype="application/vnd.sqlite3", download_name="the.db")
+        resp.content_encoding = "gzip"
+    elif os.path.exists("static/the.db"):
+        resp = flask.send_file(os.path.abspath("static/the.db"), mimetype="application/vnd.sqlite3")
+    else:
+        flask.abort(404)
+    resp.vary.add("Accept-Encoding")
     return resp
 
 @app.route("/files/<path:name>")
@@ -178,64 +277,445 @@ def external_url(lang):
         return lang.removeprefix("external ")
     return None
 
-def make_tar(num, compression=""):
-    user_id = fetch_user_id()
+EXTERNAL_TIMEOUT = (5, 20)
+# how long a fetched external file is used before checking whether it changed
+EXTERNAL_FRESH = 24 * 60 * 60
+external_pool = ThreadPoolExecutor(max_workers=8)
+
+class FetchFailed(Exception):
+    pass
+
+def fetch_external(url):
+    path = f"external/{hashlib.sha256(url.encode()).hexdigest()}"
+    try:
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        with open(path, "rb") as f:
+            content = f.read()
+    except FileNotFoundError:
+        meta = None
+        content = None
+    if meta and time.time() - meta["fetched_at"] < EXTERNAL_FRESH:
+        return content
+
+    headers = {}
+    if meta and meta["etag"]:
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta["last_modified"]:
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        r = requests.get(url, headers=headers, timeout=EXTERNAL_TIMEOUT)
+    except requests.RequestException as e:
+        logging.warning(f"failed to fetch {url}: {e}")
+        if content is None:
+            raise FetchFailed(url)
+        return content
+    if r.status_code == 304:
+        meta["fetched_at"] = time.time()
+    elif r.ok:
+        content = r.content
+        meta = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"), "fetched_at": time.time()}
+    else:
+        logging.warning(f"failed to fetch {url}: status {r.status_code}")
+        if content is None:
+            raise FetchFailed(url)
+        return content
+
+    os.makedirs("external", exist_ok=True)
+    if r.status_code != 304:
+        with tempfile.NamedTemporaryFile(dir="external", delete=False) as f:
+            f.write(content)
+        os.replace(f.name, path)
+    with tempfile.NamedTemporaryFile("w", dir="external", delete=False) as f:
+        json.dump(meta, f)
+    os.replace(f.name, path + ".json")
+    return content
+
+def file_content(hash, content):
+    # files uploaded before the blob store existed keep their content in the database until `flask store-blobs`
+    return blobs.get(hash) if hash else content
+
+def round_files(db, num, user_id, failed=None):
+    query = (
+        "FROM Files "
+        "INNER JOIN Submissions ON Submissions.round_num = Files.round_num AND Submissions.author_id = Files.author_id "
+        "INNER JOIN Rounds ON Rounds.num = Files.round_num "
+        "WHERE Files.round_num = ? AND (stage <> 1 OR Files.author_id = ?)"
+    )
+    # start fetching every external file up front so that they download in parallel
+    fetches = {}
+    for lang, in db.execute(f"SELECT lang {query} AND lang LIKE 'external %'", (num, user_id)):
+        url = external_url(lang)
+        if url not in fetches:
+            fetches[url] = external_pool.submit(fetch_external, url)
+    for name, hash, content, position, lang in db.execute(f"SELECT name, hash, content, position, lang {query}", (num, user_id)):
+        if url := external_url(lang):
+            try:
+                content = fetches[url].result()
+            except FetchFailed:
+                content = f"cg: couldn't fetch {url}".encode()
+                if failed is not None:
+                    failed.append(url)
+        else:
+            content = file_content(hash, content)
+        yield f"{num}/{position}/{name}", content
+
+def add_to_tar(tar, path, content):
+    info = tarfile.TarInfo(path)
+    info.size = len(content)
+    tar.addfile(info, io.BytesIO(content))
+
+def make_tar(num, user_id, compression=""):
+    # stream mode, so each member is compressed and handed to the client as soon as it's read
+    # this outlives the request, so it needs its own connection
+    db = connect()
     f = io.BytesIO()
-    with tarfile.open(mode=f"w:{compression}", fileobj=f) as tar:
-        for name, content, position, lang in get_db().execute(
-            "SELECT name, content, position, lang FROM Files "
-            "INNER JOIN Submissions ON Submissions.round_num = Files.round_num AND Submissions.author_id = Files.author_id "
-            "INNER JOIN Rounds ON Rounds.num = Files.round_num "
-            "WHERE Files.round_num = ? AND (stage <> 1 OR Files.author_id = ?)", (num, user_id)
-        ):
-            if url := external_url(lang):
-                content = requests.get(url).content
-            info = tarfile.TarInfo(f"{num}/{position}/{name}")
-            info.size = len(content)
-            tar.addfile(info, io.BytesIO(content))
-    f.seek(0)
-    return f
+    try:
+        with tarfile.open(mode=f"w|{compression}", fileobj=f) as tar:
+            for path, content in round_files(db, num, user_id):
+                add_to_tar(tar, path, content)
+                if chunk := f.getvalue():
+                    yield chunk
+                    f.seek(0)
+                    f.truncate()
+        yield f.getvalue()
+    finally:
+        db.close()
+
+def write_archive(f, db, num, user_id, fmt, failed=None):
+    match fmt:
+        case "tar.bz2":
+            with tarfile.open(mode="w|bz2", fileobj=f) as tar:
+                for path, content in round_files(db, num, user_id, failed):
+                    add_to_tar(tar, path, content)
+        case "tar.bz3":
+            with bz3.BZ3File(f, "wb") as z, tarfile.open(mode="w|", fileobj=z) as tar:
+                for path, content in round_files(db, num, user_id, failed):
+                    add_to_tar(tar, path, content)
+        case "zip":
+            with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as z:
+                for path, content in round_files(db, num, user_id, failed):
+                    z.writestr(path, content)
+
+ARCHIVE_FORMATS = {
+    "tar.bz2": "application/x-bzip2",
+    "tar.bz3": "application/x-bzip3",
+    "zip": "application/zip",
+}
+
+def archive_path(num, fmt):
+    return f"archives/{num}.{fmt}"
+
+def drop_archives(num):
+    for fmt in ARCHIVE_FORMATS:
+        try:
+            os.remove(archive_path(num, fmt))
+        except FileNotFoundError:
+            pass
+
+def archives_generation(db, num):
+    return db.execute("SELECT COALESCE((SELECT value FROM Counters WHERE name = ?), 0)", (f"archives {num}",)).fetchone()[0]
+
+def archives_changed(db, num):
+    # archives that any worker is still building from the round as it was are thrown away when they're done
+    db.execute("INSERT INTO Counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (f"archives {num}",))
+
+def write_round_archives(num):
+    os.makedirs("archives", exist_ok=True)
+    with contextlib.closing(connect()) as db:
+        for fmt in ARCHIVE_FORMATS:
+            path = archive_path(num, fmt)
+            if os.path.exists(path):
+                continue
+            failed = []
+            fd, tmp = tempfile.mkstemp(dir="archives", suffix=".tmp")
+            try:
+                with open(fd, "wb") as f:
+                    # all from one snapshot, so that the generation says which version of the round went into it
+                    db.execute("BEGIN")
+                    generation = archives_generation(db, num)
+                    write_archive(f, db, num, None, fmt, failed)
+                    db.rollback()
+                if failed:
+                    # don't keep it, so the next download tries those files again
+                    logging.warning(f"not keeping archives of round {num}, couldn't fetch {', '.join(failed)}")
+                    os.remove(tmp)
+                    return
+                if archives_generation(db, num) != generation:
+                    os.remove(tmp)
+                    return
+                os.replace(tmp, path)
+            except Exception:
+                os.remove(tmp)
+                raise
+            logging.info(f"built {path}")
+
+archives_lock = threading.Lock()
+# rounds whose archives this worker is building right now, and whether it was asked to again in the meantime
+archives_building = {}
+
+def write_archives(num):
+    with archives_lock:
+        if num in archives_building:
+            archives_building[num] = True
+            return
+        archives_building[num] = False
+    try:
+        while True:
+            write_round_archives(num)
+            with archives_lock:
+                if not archives_building[num]:
+                    del archives_building[num]
+                    return
+                archives_building[num] = False
+    except Exception:
+        logging.exception(f"failed to build archives of round {num}")
+        with archives_lock:
+            archives_building.pop(num, None)
+
+def build_archives(num):
+    threading.Thread(target=write_archives, args=(num,), daemon=True).start()
+
+# members past this much decompressed data aren't extracted
+ARCHIVE_LIMIT = 64 * 1024 * 1024
 
 def list_archive(content):
+    # (name, size, content) for each member, where content is None past ARCHIVE_LIMIT
     f = io.BytesIO(content)
+    total = 0
+    def extract(size, read):
+        nonlocal total
+        total += size
+        return read() if total <= ARCHIVE_LIMIT else None
     try:
         with tarfile.open(fileobj=f, errorlevel=2) as tar:
-            return [(n, g.read()) for n in tar.getnames() if (g := tar.extractfile(n))]
+            return [(m.name, m.size, extract(m.size, g.read)) for m in tar.getmembers() if (g := tar.extractfile(m))]
     except tarfile.TarError:
         f.seek(0)
         try:
             with zipfile.ZipFile(f) as z:
-                return [(n, z.read(n)) for n in z.namelist() if not n.endswith("/")]
+                return [(i.filename, i.file_size, extract(i.file_size, lambda: z.read(i))) for i in z.infolist() if not i.is_dir()]
         except zipfile.BadZipFile:
-            return [("???", b"cg: unable to read archive")]
+            message = b"cg: unable to read archive"
+            return [("???", len(message), message)]
+
+def index_archive(db, content):
+    archive = hashlib.sha256(content).hexdigest()
+    if db.execute("SELECT NULL FROM ArchiveMembers WHERE archive = ?", (archive,)).fetchone():
+        return archive
+    for name, size, member in list_archive(content):
+        if member is None:
+            db.execute("INSERT OR IGNORE INTO ArchiveMembers (archive, name, size, filetype) VALUES (?, ?, ?, ?)", (archive, name, size, "cg: not extracted, archive too large"))
+        else:
+            db.execute("INSERT OR IGNORE INTO ArchiveMembers (archive, name, size, hash, lang, filetype, encoding) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (archive, name, size, blobs.put(member), guess_language(name, member), *analyse_content(member)[:2]))
+    return archive
+
+def render_archive(content):
+    # archives that were switched to before members were indexed are indexed the first time they're shown
+    writer = get_writer()
+    archive = index_archive(writer, content)
+    writer.commit()
+    fs = [(name, None, *r) for name, *r in get_db().execute("SELECT name, lang, filetype, encoding FROM ArchiveMembers WHERE archive = ?", (archive,))]
+    return f'<div class="comments">{render_file_contents(fs, f"/member/{archive}/", fragment_stem=f"/fragment/member/{archive}/")}</div>'
+
+@app.route("/member/<archive>/<path:name>")
+def download_member(archive, name):
+    m = get_db().execute("SELECT hash FROM ArchiveMembers WHERE archive = ? AND name = ?", (archive, name)).fetchone()
+    if not m or not m["hash"]:
+        flask.abort(404)
+    resp = send_blob(m["hash"], name)
+    resp.cache_control.no_cache = None
+    resp.cache_control.max_age = FILE_MAX_AGE
+    return resp
+
+@app.route("/fragment/member/<archive>/<path:name>")
+def member_fragment(archive, name):
+    m = get_db().execute("SELECT hash, lang, encoding FROM ArchiveMembers WHERE archive = ? AND name = ?", (archive, name)).fetchone()
+    if not m or not m["hash"] or not has_display(m["lang"]):
+        flask.abort(404)
+    return cached_display(blobs.get(m["hash"]), m["lang"], m["encoding"])
 
-@app.route("/<int:num>.tar.bz2")
-def download_round_bzip2(num):
-    return flask.send_file(make_tar(num, "bz2"), mimetype="application/x-bzip2")
+@app.route("/<int:num>.<any('tar.bz2', 'tar.bz3', 'zip'):fmt>")
+def download_round(num, fmt):
+    mimetype = ARCHIVE_FORMATS[fmt]
+    db = get_db()
+    stage = db.execute("SELECT stage FROM Rounds WHERE num = ?", (num,)).fetchone()
+    if stage and stage[0] == 3:
+        # the entries of completed rounds don't change, so each archive is built once when the round ends
+        path = archive_path(num, fmt)
+        if os.path.exists(path):
+            return flask.send_file(os.path.abspath(path), mimetype=mimetype)
+        # not built yet (or couldn't be kept), so this one is made like any other round's
+        build_archives(num)
+    user_id = fetch_user_id()
+    if fmt == "tar.bz2":
+        return flask.Response(make_tar(num, user_id, "bz2"), mimetype=mimetype)
+    f = tempfile.TemporaryFile()
+    write_archive(f, db, num, user_id, fmt)
+    f.seek(0)
+    return flask.send_file(f, mimetype=mimetype)
+
+def get_names():
+    try:
+        return flask.g._names
+    except AttributeError:
+        names = dict(get_db().execute("SELECT id, name FROM People"))
+        flask.g._names = names
+        flask.g._clean_names = {}
+        return names
 
 def get_name(i):
-    return nh3.clean(get_db().execute("SELECT name FROM People WHERE id = ?", (i,)).fetchone()[0])
+    names = get_names()
+    clean = flask.g._clean_names
+    if i not in clean:
+        clean[i] = nh3.clean(names[i])
+    return clean[i]
 
 def format_time(dt):
     return f'<time role="timer" datetime="{dt.isoformat()}">{dt.isoformat()}</time>'
 
-def persona_name(author, persona, d={}):
+# answers from Canon, kept so pages can still be rendered while it's down
+# and so that roles and membership don't need to be asked for on every request
+last_known = canon.TTLCache(config.role_ttl, 4096)
+refreshing = set()
+
+# for answers that are too important to guess at
+NO_DEFAULT = object()
+
+def canon_answer(key, fetch, default=NO_DEFAULT):
+    try:
+        answer = fetch()
+    except canon.Unavailable as e:
+        logging.warning(str(e))
+        flask.g.degraded = True
+        if hit := last_known.get(key):
+            return hit[0]
+        if default is NO_DEFAULT:
+            raise
+        return default
+    last_known[key] = answer
+    return answer
+
+def refresh_answer(key, fetch):
+    try:
+        last_known[key] = fetch()
+    except canon.Unavailable as e:
+        logging.warning(str(e))
+    finally:
+        refreshing.discard(key)
+
+def cached_canon_answer(key, fetch, default=NO_DEFAULT):
+    hit = last_known.get(key)
+    if not hit:
+        return canon_answer(key, fetch, default)
+    answer, fresh = hit
+    if not fresh and key not in refreshing:
+        # answer with what we have now and ask again in the background
+        refreshing.add(key)
+        canon.pool.submit(refresh_answer, key, fetch)
+    return answer
+
+def degraded_notice():
+    if flask.g.get("degraded"):
+        return "<aside>note: canon isn't responding right now, so some names and permissions on this page may be out of date.</aside>"
+    return ""
+
+persona_names = canon.TTLCache(config.persona_ttl, 4096)
+
+def fetch_persona_name(persona):
+    try:
+        return nh3.clean(canon.get(f"/personas/{persona}").json()["name"])
+    except canon.Unavailable as e:
+        logging.warning(str(e))
+        return None
+
+# the Counters value this worker last saw for personas
+persona_generation = None
+
+def sync_persona_names():
+    # another worker may have renamed or deleted personas since we cached their names
+    global persona_generation
+    try:
+        return flask.g._persona_generation
+    except AttributeError:
+        pass
+    generation = get_db().execute("SELECT COALESCE((SELECT value FROM Counters WHERE name = 'personas'), 0)").fetchone()[0]
+    if generation != persona_generation:
+        persona_names.clear()
+        persona_generation = generation
+    flask.g._persona_generation = generation
+    return generation
+
+def personas_changed(db, personas=None):
+    # makes every worker forget the persona names it knows, and throws away pages showing the old ones.
+    # without a list of personas, any page might
+    db.execute("INSERT INTO Counters (name, value) VALUES ('personas', 1) ON CONFLICT (name) DO UPDATE SET value = value + 1")
+    if personas is None:
+        db.execute("DELETE FROM RoundPages")
+        return
+    personas = list(personas)
+    qs = ", ".join("?"*len(personas))
+    db.execute(f"DELETE FROM RoundPages WHERE round_num IN (SELECT round_num FROM Comments WHERE persona IN ({qs}) OR og_persona IN ({qs}))", personas*2)
+
+def resolve_personas(personas):
+    if not config.canon_url:
+        return
+    sync_persona_names()
+    missing = []
+    for persona in set(personas):
+        if persona is not None and persona != -1 and not ((hit := persona_names.get(persona)) and hit[1]):
+            missing.append(persona)
+    # Canon has no way to look up many personas at once, so the lookups are made side by side instead
+    for persona, name in zip(missing, canon.pool.map(fetch_persona_name, missing)):
+        if name is None:
+            flask.g.degraded = True
+        else:
+            persona_names[persona] = name
+
+def persona_name(author, persona):
     if persona == -1:
         return get_name(author) + ' <span class="verified"></span>'
     if not config.canon_url:
         return "[unknown]"
-    return d.get(persona) or d.setdefault(persona, nh3.clean(requests.get(config.canon_url + f"/personas/{persona}").json()["name"]))
+    resolve_personas([persona])
+    hit = persona_names.get(persona)
+    return hit[0] if hit else "[unknown]"
 
 def name_of_user(user):
     return user.to_json()["global_name"] or user.name
 
+Identity = namedtuple("Identity", "id name")
+# how often to ask Discord for the logged in user again, in seconds
+IDENTITY_REFRESH = 60 * 60
+
+def fetch_identity():
+    # the user's id and name are kept in the session, so most requests don't have to wait on Discord
+    cached = flask.session.get("identity")
+    if cached and time.time() - cached[2] < IDENTITY_REFRESH:
+        return Identity(cached[0], cached[1])
+    try:
+        user = discord.fetch_user()
+    except (oauth2.InvalidGrantError, flask_discord.Unauthorized):
+        flask.session.pop("identity", None)
+        return None
+    except (flask_discord.HttpException, requests.RequestException) as e:
+        if not cached:
+            raise
+        logging.warning(f"couldn't refresh identity of {cached[0]}: {e}")
+        return Identity(cached[0], cached[1])
+    flask.session["identity"] = [user.id, name_of_user(user), time.time()]
+    return Identity(user.id, name_of_user(user))
+
 def fetch_user():
     if not discord.authorized:
         return None
     try:
-        return discord.fetch_user()
-    except oauth2.InvalidGrantError:
-        return None
+        return flask.g._user
+    except AttributeError:
+        user = fetch_identity()
+        flask.g._user = user
+        return user
 
 def fetch_user_id():
     user = fetch_user()
@@ -245,19 +725,21 @@ def fetch_personas():
     user = fetch_user()
     if not user:
         return None
-    base_persona = {"id": -1, "name": name_of_user(user)}
+    base_persona = {"id": -1, "name": user.name}
     if not config.canon_url:
         return [base_persona]
     if not hasattr(flask.g, "d"):
         flask.g.d = {}
     d = flask.g.d
-    return d.get(user.id) or d.setdefault(user.id, [base_persona, *requests.get(config.canon_url + f"/users/{user.id}/personas").json()])
+    if user.id not in d:
+        d[user.id] = [base_persona, *canon_answer(("personas", user.id), lambda: canon.get(f"/users/{user.id}/personas").json(), [])]
+    return d[user.id]
 
 def is_admin(user_id):
     if not user_id:
         return False
     if isinstance(config.admin_ids, int):
-        return requests.get(config.canon_url + f"/users/{user_id}/roles/{config.admin_ids}").json()
+        return cached_canon_answer(("admin", user_id), lambda: canon.get(f"/users/{user_id}/roles/{config.admin_ids}").json(), False)
     return user_id in config.admin_ids
 
 def pass_to_js(*args):
@@ -271,13 +753,33 @@ def submission_pos_to_id(num, pos):
     db = get_db()
     return db.execute("SELECT author_id FROM Submissions WHERE round_num = ? AND position = ?", (num, pos)).fetchone()[0]
 
-def submission_id_to_pos(num, author):
-    db = get_db()
-    return db.execute("SELECT position FROM Submissions WHERE round_num = ? AND author_id = ?", (num, author)).fetchone()[0]
+def load_comments(db, num, author=None):
+    comments = defaultdict(list)
+    only = " AND Comments.parent = ?" if author is not None else ""
+    for row in db.execute(
+        "SELECT Comments.*, Replied.author_id AS reply_author, Replied.persona AS reply_persona FROM Comments "
+        "LEFT JOIN Comments AS Replied ON Replied.id = Comments.reply "
+        f"WHERE Comments.round_num = ?{only} ORDER BY Comments.id", (num,) + ((author,) if author is not None else ())
+    ):
+        comments[row["parent"]].append(row)
+    return comments
+
+def viewer_class(user_id):
+    if not user_id:
+        return "anon"
+    return "admin" if is_admin(user_id) else "player"
 
-def render_comments(db, num, parent_id):
-    parent = submission_id_to_pos(num, parent_id)
-    rows = db.execute("SELECT * FROM Comments WHERE round_num = ? AND parent = ?", (num, parent_id)).fetchall()
+# rendered pages are the same for everyone in a viewer class.
+# the parts that depend on who exactly is looking are left as markers for personalize() to fill in
+OWN_MARKER = re.compile(r"<!--own (\d+) (\d+) (\d+)-->")
+PERSONAS_MARKER = "<!--personas-->"
+DEGRADED_MARKER = "<!--degraded-->"
+
+def delete_button(num, id):
+    return f'<form method="post" action="/{num}/" class="delete-button"><input type="hidden" name="type" value="delete-comment"><input type="hidden" name="id" value="{id}"><input type="submit" value="delete"></form>'
+
+def render_comments(num, parent, rows):
+    viewer = viewer_class(fetch_user_id())
     comments = f'<details {"open"*bool(rows)}><summary><strong>comments</strong> {len(rows)}</summary><div class="comments">'
     for row in rows:
         comments += f'<div id="c{row["id"]}" class="comment"><strong>{persona_name(row["author_id"], row["persona"])}</strong>'
@@ -285,29 +787,45 @@ def render_comments(db, num, parent_id):
             comments += f'<span class="tooltip"><span class="tooltip-inner">known at the time as <strong>{persona_name(row["author_id"], row["og_persona"])}</strong></span></span>'
         extras = []
         if r := row["reply"]:
-            replied, their_persona = db.execute("SELECT author_id, persona FROM Comments WHERE round_num = ? AND parent = ? AND id = ?", (num, parent_id, r)).fetchone()
-            extras.append(f'<a href="#c{r}"><em>replying to <strong>{persona_name(replied, their_persona)}</strong></em></a>')
+            extras.append(f'<a href="#c{r}"><em>replying to <strong>{persona_name(row["reply_author"], row["reply_persona"])}</strong></em></a>')
         extras.append(f'<a href="#c{row["id"]}">¶</a>')
-        if user := fetch_user():
-            owns = row["author_id"] == user.id
-            extras.append(f'<button onclick="reply({pass_to_js(str(row["id"]), str(parent))})">reply</button>')
-            if owns:
-                extras.append(f'<button onclick="edit({pass_to_js(str(row["id"]), str(parent), row["unchanged_content"] or row["content"], row["persona"], row["reply"])})">edit</button>')
-            if owns or is_admin(user.id):
-                extras.append(f'<form method="post" action="/{num}/" class="delete-button"><input type="hidden" name="type" value="delete-comment"><input type="hidden" name="id" value="{row["id"]}"><input type="submit" value="delete"></form>')
+        if viewer != "anon":
+            extras.append(f'<button onclick="reply({pass_to_js(str(row["id"]), str(parent))})">reply</button><!--own {row["id"]} {num} {parent}-->')
+            if viewer == "admin":
+                extras.append(delete_button(num, row["id"]))
         comments += ' ' + ' '.join(extras)
         comments += f'{markdown(row["content"])}</div><hr>'
     comments += "<h3>post a comment</h3>"
-    if not (personas := fetch_personas()):
+    if viewer == "anon":
         comments += f"<p>{LOGIN_BUTTON}</p>"
     else:
-        comments += f'<form method="post" action="/{num}/" id="post-{parent}"><input type="hidden" name="type" value="comment"><input type="hidden" name="parent" value="{parent}">as <select name="persona">'
-        for idx, persona in enumerate(personas):
-            comments += f'<option value="{persona["id"]}" {" selected"*(not idx)}>{persona["name"]}</option>'
-        comments += '</select><span class="extra"></span><p><textarea class="comment-content" name="content" onkeypress="considerSubmit(event)" autocomplete="off" maxlength="1000"></textarea></p></form>'
+        comments += f'<form method="post" action="/{num}/" id="post-{parent}"><input type="hidden" name="type" value="comment"><input type="hidden" name="parent" value="{parent}">as <select name="persona">{PERSONAS_MARKER}</select>'
+        comments += '<span class="extra"></span><p><textarea class="comment-content" name="content" onkeypress="considerSubmit(event)" autocomplete="off" maxlength="1000"></textarea></p></form>'
     comments += "</div></details>"
     return comments
 
+def personalize(page):
+    if (user := fetch_user()) and (marked := [int(m[0]) for m in OWN_MARKER.findall(page)]):
+        # only the comments on this page; a page can have more of them than SQLite allows parameters
+        owned = {str(row["id"]): row for row in get_db().execute(
+            "SELECT id, content, unchanged_content, persona, reply FROM Comments WHERE author_id = ? AND id IN (SELECT value FROM json_each(?))", (user.id, json.dumps(marked))
+        )}
+        admin = is_admin(user.id)
+        def own_controls(m):
+            id, num, parent = m.groups()
+            if not (row := owned.get(id)):
+                return ""
+            controls = f' <button onclick="edit({pass_to_js(id, parent, row["unchanged_content"] or row["content"], row["persona"], row["reply"])})">edit</button>'
+            if not admin:
+                controls += " " + delete_button(num, id)
+            return controls
+        page = OWN_MARKER.sub(own_controls, page)
+    if user and PERSONAS_MARKER in page:
+        options = "".join(f'<option value="{persona["id"]}" {" selected"*(not idx)}>{persona["name"]}</option>' for idx, persona in enumerate(fetch_personas()))
+        page = page.replace(PERSONAS_MARKER, options)
+    # last, so that it also covers the calls made above
+    return page.replace(DEGRADED_MARKER, degraded_notice())
+
 def lang_display(lang):
     if not lang:
         return "No display"
@@ -321,10 +839,31 @@ def lang_display(lang):
         return "Embedded page"
     return get_lexer_by_name(lang).name
 
-def render_file(name, content, lang, url=None, dropdown_name=None, languages=None):
+def placeholder(src, text):
+    # filled in by main.js once it comes into view
+    return f'<div class="fragment" data-src="{src}"><a href="{src}">{text}</a></div>'
+
+def analyse_content(content):
     filetype = magic.from_buffer(content)
     # remove appalling attempts at guessing language
     filetype = re.sub(r"^.+? (?:source|script(?: executable)?|program|document), |(?<=text) executable", "", filetype)
+    try:
+        text = content.decode()
+        encoding = "utf-8"
+    except UnicodeDecodeError:
+        best = charset_normalizer.from_bytes(content).best()
+        text = str(best) if best else None
+        encoding = best.encoding if best else None
+    return filetype, encoding, None if text is None else len(text)
+
+def stored_analysis(content, filetype, encoding):
+    # files that haven't been through `flask analyse` yet and members of archives aren't stored, so work it out now
+    if filetype is None:
+        filetype, encoding, _ = analyse_content(content)
+    return filetype, encoding
+
+def render_file(name, content, lang, filetype=None, encoding=None, url=None, dropdown_name=None, languages=None, fragment=None):
+    filetype, encoding = stored_analysis(content, filetype, encoding)
 
     if (ext := external_url(lang)) and url:
         url = ext
@@ -354,47 +893,187 @@ def render_file(name, content, lang, url=None, dropdown_name=None, languages=Non
         elif lang == "pdf":
             file += f'<object type="application/pdf" data="{url}" width="1280" height="720"></object>'
         elif lang == "archive":
-            file += '<div class="comments">'
-            file += render_file_contents([(n, c, guess_language(n, c)) for n, c in list_archive(content)])
-            file += '</div>'
+            file += render_archive(content)
+        elif fragment:
+            file += placeholder(fragment, "show contents")
         else:
-            try:
-                text = content.decode()
-            except UnicodeDecodeError:
-                best = charset_normalizer.from_bytes(content).best()
-                text = str(best) if best else "cg: couldn't decode file contents"
-            file += highlight(text, get_lexer_by_name(lang), formatter)
+            file += cached_display(content, lang, encoding)
         file += "</details>"
 
     return file
 
+def render_display(content, lang, encoding):
+    text = content.decode(encoding) if encoding else "cg: couldn't decode file contents"
+    return highlight(text, get_lexer_by_name(lang), formatter)
+
+def display_key(content, lang):
+    return hashlib.sha256(f"{RENDERER}\0{lang}\0".encode() + content).hexdigest()
+
+def write_cache(db, query, params):
+    # a cache that can't be written to right now is no reason to fail
+    try:
+        db.execute(query, params)
+        db.commit()
+    except sqlite3.OperationalError as e:
+        db.rollback()
+        logging.warning(f"couldn't write to cache: {e}")
+
+def has_display(lang):
+    return lang is not None and lang not in ("image", "pdf", "archive") and not lang.startswith("iframe") and not external_url(lang)
+
+def round_jobs(db, num):
+    # the displays of a round that aren't cached yet
+    jobs = {}
+    for hash, content, lang, filetype, encoding in db.execute("SELECT hash, content, lang, filetype, encoding FROM Files WHERE round_num = ?", (num,)):
+        if has_display(lang):
+            content = file_content(hash, content)
+            jobs.setdefault(display_key(content, lang), (content, lang, stored_analysis(content, filetype, encoding)[1]))
+    for key, in db.execute("SELECT key FROM Displays WHERE key IN (SELECT value FROM json_each(?))", (json.dumps(list(jobs)),)).fetchall():
+        del jobs[key]
+    return jobs
+
+def prerender(nums):
+    # fill Displays for whole rounds at once using every core, so nobody has to wait for pygments
+    if not config.cache_display:
+        return
+    db = connect()
+    try:
+        rendered = 0
+        # forking a process that has other threads running can leave the child holding locks that nobody will release
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver")) as pool:
+            # a round at a time, so that only one round's files are ever held in memory
+            for num in nums:
+                futures = {pool.submit(render_display, *job): key for key, job in round_jobs(db, num).items()}
+                for future in as_completed(futures):
+                    try:
+                        display = future.result()
+                    except Exception:
+                        logging.exception(f"failed to prerender display {futures[future]}")
+                        continue
+                    write_cache(db, "INSERT OR IGNORE INTO Displays (key, html) VALUES (?, ?)", (futures[future], display))
+                    rendered += 1
+        if rendered:
+            logging.info(f"prerendered {rendered} displays for rounds {', '.join(map(str, nums))}")
+    finally:
+        db.close()
+
+@app.cli.command()
+def store_blobs():
+    """Move the content of files out of the database and into the blob store."""
+    db = get_db()
+    for num, name in db.execute("SELECT round_num, name FROM Files WHERE hash IS NULL").fetchall():
+        content, = db.execute("SELECT content FROM Files WHERE round_num = ? AND name = ?", (num, name)).fetchone()
+        db.execute("UPDATE Files SET hash = ?, content = NULL WHERE round_num = ? AND name = ?", (blobs.put(content), num, name))
+        db.commit()
+    db.execute("VACUUM")
+
+@app.cli.command()
+def compress_blobs():
+    """Compress the blobs that were stored before blobs were compressed, and uncompress ones too big to serve compressed."""
+    for hash in list(blobs.hashes()):
+        blobs.compress(hash)
+
+@app.cli.command()
+def analyse():
+    """Store the filetype, encoding and length of files uploaded before these were worked out at upload."""
+    db = get_db()
+    for num, name in db.execute("SELECT round_num, name FROM Files WHERE filetype IS NULL").fetchall():
+        content = file_content(*db.execute("SELECT hash, content FROM Files WHERE round_num = ? AND name = ?", (num, name)).fetchone())
+        db.execute("UPDATE Files SET filetype = ?, encoding = ?, text_length = ? WHERE round_num = ? AND name = ?", (*analyse_content(content), num, name))
+        db.commit()
+
+@app.cli.command()
+@click.argument("nums", type=int, nargs=-1)
+def warm(nums):
+    """Render and cache the display of every file in some rounds (all of them by default)."""
+    if not nums:
+        nums = [n for n, in get_db().execute("SELECT num FROM Rounds WHERE stage")]
+    prerender(nums)
+
+def cached_display(content, lang, encoding):
+    # outside of a request (e.g. in a worker process) there's nowhere to keep it
+    if not config.cache_display or not flask.has_app_context():
+        return render_display(content, lang, encoding)
+    db = get_db()
+    key = display_key(content, lang)
+    if row := db.execute("SELECT html FROM Displays WHERE key = ?", (key,)).fetchone():
+        return row[0]
+    display = render_display(content, lang, encoding)
+    write_cache(get_writer(), "INSERT OR IGNORE INTO Displays (key, html) VALUES (?, ?)", (key, display))
+    return display
+
 def root_dir(r):
     return r[0].parts[0] if len(r[0].parts) > 1 else None
 
-def _render_file_contents(fs, url_stem, languages):
+def _render_file_contents(fs, url_stem, languages, fragment_stem):
     out = ""
     fs.sort(key=lambda r: (not root_dir(r), r[0]))
     for dir_name, g in itertools.groupby(fs, root_dir):
         if dir_name:
             out += f'<details><summary>dir <strong>{dir_name}</strong></summary><div class="comments">'
             new_fs = [(path.relative_to(dir_name), *r) for path, *r in g]
-            out += _render_file_contents(new_fs, url_stem, languages)
+            out += _render_file_contents(new_fs, url_stem, languages, fragment_stem)
             out += '</div></details>'
         else:
-            for path, full_name, content, lang in g:
-                out += render_file(path.name, content, lang, url_stem + full_name if url_stem else None, full_name, languages)
+            for path, full_name, content, lang, filetype, encoding in g:
+                out += render_file(path.name, content, lang, filetype, encoding, url_stem + full_name if url_stem else None, full_name, languages, fragment_stem + full_name if fragment_stem else None)
     return out
 
-def render_file_contents(fs, url_stem=None, languages=None):
-    return _render_file_contents([(PurePosixPath(name), name, *r) for name, *r in fs], url_stem, languages)
-
-def render_files(db, num, author, languages=None):
-    fs = db.execute("SELECT name, content, lang FROM Files WHERE author_id = ? AND round_num = ?", (author, num)).fetchall()
-    return render_file_contents(fs, f"/{num}/", languages)
+def render_file_contents(fs, url_stem=None, languages=None, fragment_stem=None):
+    return _render_file_contents([(PurePosixPath(name), name, *r) for name, *r in fs], url_stem, languages, fragment_stem)
+
+def render_files(db, num, author, languages=None, fragment_stem=None):
+    fs = []
+    for name, hash, content, lang, filetype, encoding in db.execute("SELECT name, hash, content, lang, filetype, encoding FROM Files WHERE author_id = ? AND round_num = ?", (author, num)):
+        # most files only get a header and a placeholder, which don't need what's in them
+        if filetype is None or lang == "archive" or not fragment_stem and has_display(lang):
+            content = file_content(hash, content)
+        fs.append((name, content, lang, filetype, encoding))
+    return render_file_contents(fs, f"/{num}/", languages, fragment_stem)
+
+def fragment_author(num, pos):
+    author = get_db().execute("SELECT author_id FROM Submissions INNER JOIN Rounds ON num = round_num WHERE round_num = ? AND position = ? AND stage >= 2", (num, pos)).fetchone()
+    if not author:
+        flask.abort(404)
+    return author[0]
 
+@app.route("/fragment/<int:num>/<int:pos>")
+def entry_fragment(num, pos):
+    return render_files(get_db(), num, fragment_author(num, pos), fragment_stem=f"/fragment/{num}/{pos}/")
 
-def render_submission(db, row, show_info, written_by=True):
-    author, num, submitted_at, cached_display, position, target = row
+@app.route("/fragment/<int:num>/<int:pos>/<path:name>")
+def file_fragment(num, pos, name):
+    f = get_db().execute("SELECT hash, content, lang, filetype, encoding FROM Files WHERE round_num = ? AND author_id = ? AND name = ?", (num, fragment_author(num, pos), name)).fetchone()
+    if not f or not has_display(f["lang"]):
+        flask.abort(404)
+    content = file_content(f["hash"], f["content"])
+    _, encoding = stored_analysis(content, f["filetype"], f["encoding"])
+    return cached_display(content, f["lang"], encoding)
+
+
+def load_round(db, num, show_info, author=None):
+    # everything render_submission needs about a round, fetched in a fixed number of queries.
+    # given an author, only what's needed to render their submission is loaded
+    your_id = fetch_user_id()
+    only_liked = " AND liked = ?" if author is not None else ""
+    only_actual = " AND actual = ?" if author is not None else ""
+    only = (author,) if author is not None else ()
+    loaded = {
+        "comments": load_comments(db, num, author),
+        "likes": {},
+        "guesses": defaultdict(list),
+        "your_likes": {liked for liked, in db.execute(f"SELECT liked FROM Likes WHERE round_num = ? AND player_id = ?{only_liked}", (num, your_id) + only)},
+        "playing": bool(your_id and db.execute("SELECT NULL FROM Submissions WHERE round_num = ? AND author_id = ?", (num, your_id)).fetchone()),
+    }
+    if show_info:
+        loaded["likes"] = dict(db.execute(f"SELECT liked, COUNT(*) FROM Likes WHERE round_num = ?{only_liked} GROUP BY liked", (num,) + only))
+        for guesser, guess, actual in db.execute(f"SELECT player_id, guess, actual FROM Guesses WHERE round_num = ?{only_actual}", (num,) + only):
+            loaded["guesses"][actual].append((guesser, guess))
+    resolve_personas(row[key] for rows in loaded["comments"].values() for row in rows for key in ("persona", "og_persona"))
+    return loaded
+
+def render_submission(db, row, show_info, loaded, written_by=True):
+    author, num, submitted_at, position, target = row
     entries = "<p>"
     if show_info:
         name = get_name(author)
@@ -404,11 +1083,11 @@ def render_submission(db, row, show_info, written_by=True):
             entries += f"submitted at {format_time(submitted_at)}<br>"
         if target:
             entries += f"impersonating {get_name(target)}<br>"
-        likes, = db.execute("SELECT COUNT(*) FROM Likes WHERE round_num = ? AND liked = ?", (num, author)).fetchone()
+        likes = loaded["likes"].get(author, 0)
         if num >= config.likes_since:
             entries += "1 like" if likes == 1 else f"{likes} likes"
         entries += "</p><details><summary><strong>guesses</strong></summary><ul>"
-        for guesser, guess_id in sorted(db.execute("SELECT player_id, guess FROM Guesses WHERE round_num = ? AND actual = ?", (num, author)), key=lambda x: get_name(x[1])):
+        for guesser, guess_id in sorted(loaded["guesses"][author], key=lambda x: get_name(x[1])):
             guess = get_name(guess_id)
             if guess_id == author:
                 guess = f"<strong>{guess}</strong>"
@@ -416,24 +1095,21 @@ def render_submission(db, row, show_info, written_by=True):
                 guess = f"<em>{guess}</em>"
             entries += f"<li>{guess} (by {get_name(guesser)})</li>"
         entries += "</ul></details>"
-    elif (your_id := fetch_user_id()) and db.execute("SELECT NULL FROM Submissions WHERE round_num = ? AND author_id = ?", (num, your_id)).fetchone():
-        checked = " togglevalue"*bool(db.execute("SELECT NULL FROM Likes WHERE round_num = ? AND player_id = ? AND liked = ?", (num, your_id, author)).fetchone())
+    elif loaded["playing"]:
+        checked = " togglevalue"*(author in loaded["your_likes"])
         entries += f'<p><button class="toggle" alt="unlike" ontoggle="onLike({position})"{checked}>like</button></p>'
-    entries += render_comments(db, num, author)
+    entries += render_comments(num, position, loaded["comments"][author])
     entries += "<br>"
-    if not cached_display or not config.cache_display:
-        cached_display = render_files(db, num, author)
-        db.execute("UPDATE Submissions SET cached_display = ? WHERE round_num = ? AND author_id = ?", (cached_display, num, author))
-        db.commit()
-    entries += cached_display
+    entries += placeholder(f"/fragment/{num}/{position}", "show files")
     return entries
 
 def render_submissions(db, num, show_info):
-    entries = f'<p>you can <a id="download" href="/{num}.tar.bz2">download</a> all the entries</p>'
-    for r in db.execute("SELECT author_id, round_num, submitted_at, cached_display, position, target FROM Submissions WHERE round_num = ? ORDER BY position", (num,)):
+    loaded = load_round(db, num, show_info)
+    entries = f'<p>you can <a id="download" href="/{num}.tar.bz2">download</a> all the entries (also as <a href="/{num}.tar.bz3">.tar.bz3</a> or <a href="/{num}.zip">.zip</a>)</p>'
+    for r in db.execute("SELECT author_id, round_num, submitted_at, position, target FROM Submissions WHERE round_num = ? ORDER BY position", (num,)):
         position = r["position"]
         entries += f'<div class="entry"><h3 id="{position}">entry #{position}</h3>'
-        entries += render_submission(db, r, show_info)
+        entries += render_submission(db, r, show_info, loaded)
         entries += "</div>"
     return entries
 
@@ -471,7 +1147,51 @@ META = f"""
 LOGIN_BUTTON = '<form method="get" action="/login"><input type="submit" value="log in with discord"></form>'
 
 def score_round(num):
-    return get_db().execute("SELECT rank, player_id, total, plus, bonus, minus, won FROM Scores WHERE round_num = ? ORDER BY rank", (num,))
+    return get_db().execute("SELECT rank, player_id, total, plus, bonus, minus, won FROM RoundScores WHERE round_num = ? ORDER BY rank", (num,))
+
+def store_scores(db, num):
+    db.execute("DELETE FROM RoundScores WHERE round_num = ?", (num,))
+    db.execute(
+        "INSERT INTO RoundScores (round_num, player_id, rank, total, plus, bonus, minus, won) "
+        "SELECT round_num, player_id, rank, total, plus, bonus, minus, won FROM Scores WHERE round_num = ?", (num,)
+    )
+
+TOTALS_QUERY = """
+INSERT INTO RunningTotals
+SELECT
+    s.round_num, s.player_id,
+    s.total + COALESCE(p.total, 0),
+    s.plus + COALESCE(p.plus, 0),
+    s.bonus + COALESCE(p.bonus, 0),
+    s.minus + COALESCE(p.minus, 0),
+    1 + COALESCE(p.played, 0),
+    s.won + COALESCE(p.won, 0),
+    (SELECT COUNT(*) FROM Likes WHERE round_num = s.round_num AND liked = s.player_id) + COALESCE(p.likes, 0)
+FROM RoundScores s LEFT JOIN RunningTotals p ON p.player_id = s.player_id
+    AND p.round_num = (SELECT MAX(round_num) FROM RunningTotals WHERE player_id = s.player_id AND round_num < s.round_num)
+WHERE s.round_num = ?
+"""
+
+def index_totals(db, since):
+    db.execute("DELETE FROM RunningTotals WHERE round_num >= ?", (since,))
+    for num, in db.execute("SELECT num FROM Rounds WHERE stage = 3 AND num >= ? ORDER BY num", (since,)).fetchall():
+        db.execute(TOTALS_QUERY, (num,))
+
+@app.cli.command()
+@click.argument("nums", type=int, nargs=-1)
+def rescore(nums):
+    """Recompute the stored scores of completed rounds (all of them by default).
+
+    Run this after changing rank_override or bonus_given by hand.
+    """
+    db = get_db()
+    if not nums:
+        nums = [n for n, in db.execute("SELECT num FROM Rounds WHERE stage = 3")]
+    for num in nums:
+        store_scores(db, num)
+        db.execute("DELETE FROM RoundPages WHERE round_num = ?", (num,))
+    index_totals(db, min(nums, default=1))
+    db.commit()
 
 def show_spec(rnd):
     return f"<h2>specification</h2>{markdown_html(rnd['spec'])}"
@@ -552,6 +1272,7 @@ def show_round(num):
             entry_count, = db.execute("SELECT COUNT(*) FROM Submissions WHERE round_num = ?", (num,)).fetchone()
             entries = f"<strong>{entry_count}</strong> entries have been received so far." if entry_count != 1 else "<strong>1</strong> entry has been received so far."
             submit_by = rnd['stage2_at']
+            warning = join_warning(user_id)
             meta_desc = html.escape(f"{get_summary(rnd['spec'])} submit by {submit_by.strftime('%B %d (%A)')}.")
             return f"""
 <!DOCTYPE html>
@@ -565,13 +1286,14 @@ def show_round(num):
   </head>
   <body>
     {top}
+    {degraded_notice()}
     <h1>{config.t}, round #{num}, stage 1 (writing)</h1>
     <p>started at {format_time(rnd['started_at'])}. submit by {format_time(submit_by)}</p>
     {show_spec(rnd)}
     <h2>entries</h2>
     <p>{entries}</p>
     <h2>submit</h2>
-    {join_warning(user_id)}
+    {warning}
     <p>{flash()}</p>
     {panel}
   </body>
@@ -613,7 +1335,7 @@ def show_round(num):
                 else:
                     panel += "<p>you weren't a part of this round. come back next time?</p>"
             guess_by = rnd['ended_at']
-            return f"""
+            return personalize(f"""
 <!DOCTYPE html>
 <html>
   <head>
@@ -626,6 +1348,7 @@ def show_round(num):
   </head>
   <body>
     {top}
+    {DEGRADED_MARKER}
     <h1>{config.t}, round #{num}, stage 2 (guessing)</h1>
     <p>started at {format_time(rnd['started_at'])}; stage 2 since {format_time(rnd['stage2_at'])}. guess by {format_time(guess_by)}</p>
     {show_spec(rnd)}
@@ -634,8 +1357,12 @@ def show_round(num):
     {entries}
   </body>
 </html>
-"""
+""")
         case 3:
+            viewer = viewer_class(user_id)
+            generation = sync_persona_names()
+            if cached := db.execute("SELECT html FROM RoundPages WHERE round_num = ? AND viewer = ? AND version = ?", (num, viewer, PAGES)).fetchone():
+                return personalize(cached[0])
             entries = render_submissions(db, num, True)
             results = "<ol>"
             players = list(score_round(num))
@@ -657,7 +1384,7 @@ def show_round(num):
                         results += f'<li value="{pos}">{get_name(guess)} (was {get_name(actual)})</li>'
                 results += "</ol></details></li>"
             results += "</ol>"
-            return f"""
+            page = f"""
 <!DOCTYPE html>
 <html>
   <head>
@@ -669,6 +1396,7 @@ def show_round(num):
   </head>
   <body>
     {top}
+    {DEGRADED_MARKER}
     <h1>{config.t}, round #{num} (completed)</h1>
     <p>started at {format_time(rnd['started_at'])}; stage 2 at {format_time(rnd['stage2_at'])}; ended at {format_time(rnd['ended_at'])}</p>
     {show_spec(rnd)}
@@ -679,6 +1407,12 @@ def show_round(num):
   </body>
 </html>
 """
+            # completed rounds hardly ever change, so keep the page until something on it does
+            # unless personas changed while it was being rendered, in which case it might have old names on it
+            if not flask.g.get("degraded"):
+                write_cache(get_writer(), "INSERT OR REPLACE INTO RoundPages (round_num, viewer, version, html) SELECT ?, ?, ?, ? "
+                                          "WHERE COALESCE((SELECT value FROM Counters WHERE name = 'personas'), 0) = ?", (num, viewer, PAGES, page, generation))
+            return personalize(page)
 
 def guess_language(filename, content):
     if not content or len(content) > 64*1024:
@@ -694,7 +1428,8 @@ def guess_language(filename, content):
 def can_play(user_id):
     if not config.canon_url:
         return True
-    return requests.get(config.canon_url + f"/users/{user_id}").json()["can_play"]
+    # people we've heard about before keep their last known answer while Canon is down, but nobody new gets in
+    return cached_canon_answer(("can_play", user_id), lambda: canon.get(f"/users/{user_id}").json()["can_play"])
 
 @app.route("/<int:num>/", methods=["POST"])
 def take(num):
@@ -708,7 +1443,10 @@ def take(num):
     if not can_play(user.id):
         logging.info(f"{user.id} not on server, forbidding")
         flask.abort(403)
-    db.execute("INSERT OR REPLACE INTO People VALUES (?, ?)", (user.id, name_of_user(user)))
+    if (old := db.execute("SELECT name FROM People WHERE id = ?", (user.id,)).fetchone()) and old[0] != user.name:
+        db.execute("DELETE FROM RoundPages")
+    db.execute("INSERT OR REPLACE INTO People VALUES (?, ?)", (user.id, user.name))
+    flask.g.pop("_names", None)
     anchor = None
     form = flask.request.form
     try:
@@ -722,7 +1460,8 @@ def take(num):
                 for file in files:
                     b = file.read()
                     guess = guess_language(file.filename, b)
-                    db.execute("INSERT INTO Files (name, author_id, round_num, content, lang) VALUES (?, ?, ?, ?, ?)", (file.filename, user.id, num, b, guess))
+                    db.execute("INSERT INTO Files (name, author_id, round_num, hash, lang, filetype, encoding, text_length) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (file.filename, user.id, num, blobs.put(b), guess, *analyse_content(b)))
                 logging.info(f"accepted files {', '.join(str(x.filename) for x in files)} from {user.id}")
                 flask.flash("submitted successfully")
             case ("langs", 1):
@@ -753,7 +1492,10 @@ def take(num):
                     logging.info(f"{user.id} finished guessing")
                     all_done, = db.execute("SELECT MIN(finished_guessing) FROM Submissions WHERE round_num = ?", (num,)).fetchone()
                     if config.canon_url and all_done:
-                        requests.post(config.canon_url + "/round-over", json=config.admin_ids)
+                        try:
+                            canon.post("/round-over", json=config.admin_ids)
+                        except canon.Unavailable as e:
+                            logging.warning(f"couldn't announce that guessing is over: {e}")
             case ("like", 2):
                 for pos in form.getlist("position"):
                     author_id, = db.execute("SELECT author_id FROM Submissions WHERE round_num = ? AND position = ?", (num, int(pos))).fetchone()
@@ -765,6 +1507,7 @@ def take(num):
                         db.execute("INSERT OR IGNORE INTO Likes VALUES (?, ?, ?)", (num, user.id, author_id))
                         logging.info(f"{user.id} liked {author_id}")
             case ("comment", 2 | 3):
+                db.execute("DELETE FROM RoundPages WHERE round_num = ?", (num,))
                 parent = submission_pos_to_id(num, int(form["parent"]))
                 persona = int(form["persona"])
                 reply = int(form["reply"]) if "reply" in form else None
@@ -772,7 +1515,7 @@ def take(num):
                 content = form["content"]
                 if persona != -1:
                     unchanged_content = content
-                    content = requests.post(config.canon_url + f"/users/{user.id}/transform", json={"text": content, "persona": persona}).json()["text"]
+                    content = canon.post(f"/users/{user.id}/transform", json={"text": content, "persona": persona}).json()["text"]
                 time = datetime.datetime.now(datetime.timezone.utc)
                 if edit := form.get("edit"):
                     owner, = db.execute("SELECT author_id FROM Comments WHERE id = ?", (edit,)).fetchone()
@@ -795,7 +1538,10 @@ def take(num):
                     if reply:
                         reply_author, = db.execute("SELECT author_id FROM Comments WHERE id = ?", (reply,)).fetchone()
                     if config.canon_url:
-                        requests.post(config.canon_url + "/notify", json={"reply": reply_author, "parent": parent, "persona": persona, "user": user.id, "content": content, "url": f"{config.canonical}/{num}/#c{id}"})
+                        try:
+                            canon.post("/notify", json={"reply": reply_author, "parent": parent, "persona": persona, "user": user.id, "content": content, "url": f"{config.canonical}/{num}/#c{id}"})
+                        except canon.Unavailable as e:
+                            logging.warning(f"couldn't send notifications for comment {id}: {e}")
             case ("delete-comment", 2 | 3):
                 id = form["id"]
                 owner, pos = db.execute(
@@ -805,6 +1551,7 @@ def take(num):
                 if user.id != owner and not is_admin(user.id):
                     flask.abort(403)
                 db.execute("DELETE FROM Comments WHERE id = ?", (id,))
+                db.execute("DELETE FROM RoundPages WHERE round_num = ?", (num,))
                 anchor = str(pos)
                 logging.info(f"{user.id} deleted their comment {id}")
             case _:
@@ -834,6 +1581,29 @@ def build_table(cols, rows):
 
 SEASON_EVERY = 10
 
+LEADERBOARD_QUERY = """
+WITH bounds AS (
+    SELECT
+        id,
+        (SELECT MAX(round_num) FROM RunningTotals WHERE player_id = id AND round_num < ?1) AS lo,
+        (SELECT MAX(round_num) FROM RunningTotals WHERE player_id = id AND round_num <= ?2) AS hi
+    FROM People
+)
+SELECT
+    id,
+    h.total - COALESCE(l.total, 0),
+    h.plus - COALESCE(l.plus, 0),
+    h.bonus - COALESCE(l.bonus, 0),
+    h.minus - COALESCE(l.minus, 0),
+    h.played - COALESCE(l.played, 0),
+    h.won - COALESCE(l.won, 0),
+    h.likes - COALESCE(l.likes, 0)
+FROM bounds
+    INNER JOIN RunningTotals h ON h.player_id = id AND h.round_num = hi
+    LEFT JOIN RunningTotals l ON l.player_id = id AND l.round_num = lo
+WHERE h.played > COALESCE(l.played, 0)
+"""
+
 @app.route("/stats/")
 def stats():
     db = get_db()
@@ -843,7 +1613,7 @@ def stats():
         before_round = min(max(int(flask.request.args.get("before", round_count)), after_round), round_count)
     except ValueError:
         flask.abort(400)
-    rounds = db.execute("SELECT num FROM Rounds WHERE stage = 3 AND num >= ? AND num <= ?", (after_round, before_round)).fetchall()
+    rounds, = db.execute("SELECT COUNT(*) FROM Rounds WHERE stage = 3 AND num >= ? AND num <= ?", (after_round, before_round)).fetchone()
 
     top_buttons = []
     season, off = divmod(after_round - 1, SEASON_EVERY)
@@ -856,17 +1626,10 @@ def stats():
                 top_buttons.append(f'<a href="?after={start}&before={min(end, round_count)}">{name} season</a>')
     if not top_buttons:
         top_buttons.append('<a href=".">latest season</a>')
-    if len(rounds) != round_count:
+    if rounds != round_count:
         top_buttons.append('<a href="?after=1">all time leaderboard</a>')
 
-    lb = defaultdict(lambda: [0]*7)
-    for num, in rounds:
-        for rank, player, total, plus, bonus, minus, won in score_round(num):
-            p = lb[player]
-            for i, x in enumerate((total, plus, bonus, minus, 1, won)):
-                p[i] += x
-    for player, count in db.execute("SELECT liked, COUNT(*) FROM Likes WHERE round_num >= ? AND round_num <= ? GROUP BY liked", (after_round, before_round)):
-        lb[player][-1] += count
+    lb = {player: totals for player, *totals in db.execute(LEADERBOARD_QUERY, (after_round, before_round))}
 
     bonus_col = any(n in config.bonus_rounds for n in range(after_round, before_round+1))
     like_col = before_round >= config.likes_since
@@ -888,8 +1651,6 @@ def stats():
 
     e = list(rank_enumerate(lb.items(), key=lambda t: t[1][0]))
     for rank, (player, (total, plus, bonus, minus, played, won, likes)) in e:
-        if not played:
-            continue
         name = get_name(player)
         rows.append([
             rank,
@@ -955,13 +1716,13 @@ def user_stats(player):
     scourges = build_table(cols, db.execute(FIND.format(SCOURGES), (player_id,)).fetchall())
     s = ""
     sc = 0
-    for r in db.execute("SELECT author_id, round_num, submitted_at, cached_display, position, target FROM Submissions INNER JOIN Rounds ON num = round_num WHERE stage = 3 AND author_id = ? ORDER BY round_num DESC", (player_id,)):
+    for r in db.execute("SELECT author_id, round_num, submitted_at, position, target FROM Submissions INNER JOIN Rounds ON num = round_num WHERE stage = 3 AND author_id = ? ORDER BY round_num DESC", (player_id,)):
         position = r["position"]
         num = r["round_num"]
         s += f'<h3 id="{num}"><a href="/{num}/#{position}">round #{num}</a></h3>'
-        s += render_submission(db, r, True, written_by=False)
+        s += render_submission(db, r, True, load_round(db, num, True, player_id), written_by=False)
         sc += 1
-    return f"""
+    return personalize(f"""
 <!DOCTYPE html>
 <html>
   <head>
@@ -983,7 +1744,7 @@ def user_stats(player):
     {s}
   </body>
 </html>
-"""
+""")
 
 @app.route("/anon")
 def canon_settings():
@@ -992,8 +1753,8 @@ def canon_settings():
     elif not (user := fetch_user_id()):
         panel = LOGIN_BUTTON
     else:
-        settings = requests.get(config.canon_url + f"/users/{user}/settings").json()
-        personas = requests.get(config.canon_url + f"/users/{user}/personas").json()
+        settings = canon.get(f"/users/{user}/settings").json()
+        personas = canon.get(f"/users/{user}/personas").json()
         panel = '<form method="post"><input type="submit" class="hidden-submit" name="add"><h3>personas</h3><p>the names that belong to you. temporary personas will be removed and remade each round.</p><ul>'
         for persona in personas:
             end = f'<input type="submit" name="{persona["id"]}" value="delete">' if not persona["temp"] else "<em>(temp)</em>"
@@ -1026,13 +1787,17 @@ def change_settings():
     user = fetch_user_id()
     if not user:
         flask.abort(403)
-    requests.post(config.canon_url + f"/users/{user}/settings", json=flask.request.form.to_dict())
+    canon.post(f"/users/{user}/settings", json=flask.request.form.to_dict())
     if "add" in flask.request.form:
-        r = requests.post(config.canon_url + f"/users/{user}/personas", json={"name": flask.request.form["name"]}).json()
+        r = canon.post(f"/users/{user}/personas", json={"name": flask.request.form["name"]}).json()
         if r["result"] == "taken":
             flask.flash("that name is taken or reserved")
     elif (d := next(iter(flask.request.form.keys()))).isdigit() and flask.request.form[d] == "delete":
-        requests.delete(config.canon_url + f"/personas/{d}")
+        canon.delete(f"/personas/{d}")
+        persona_names.pop(int(d))
+        db = get_db()
+        personas_changed(db, [int(d)])
+        db.commit()
     return flask.redirect(flask.url_for("canon_settings"))
 
 @app.route("/admin/")
@@ -1068,6 +1833,12 @@ def panel(num):
             entries += render_files(db, num, author, ADMIN_LANGUAGES)
         entries += '<p><input type="submit" value="update languages"></p>'
 
+    latencies = ""
+    if config.canon_url:
+        with canon.latencies_lock:
+            rows = [(e, calls, failures, total / calls * 1000, slowest * 1000) for e, (calls, failures, total, slowest) in sorted(canon.latencies.items())]
+        latencies = f'<details><summary>canon latency (this worker)</summary>{build_table(["endpoint", "calls", "failures", "mean ms", "max ms"], rows)}</details>'
+
     return f"""
 <!DOCTYPE html>
 <html>
@@ -1098,13 +1869,69 @@ def panel(num):
       {show_spec(rnd)}
       {entries}
     </form>
+    {latencies}
   </body>
 </html>
 """
 
-def backup(num):
+backup_lock = threading.Lock()
+
+def write_backup(num):
     os.makedirs("backups", exist_ok=True)
-    shutil.copy("the.db", f"backups/{num}.db")
+    with backup_lock:
+        # into a temporary file first, so a backup that fails halfway doesn't replace a good one
+        fd, tmp = tempfile.mkstemp(dir="backups", suffix=".tmp")
+        os.close(fd)
+        try:
+            with contextlib.closing(connect()) as src, contextlib.closing(sqlite3.connect(tmp)) as dst:
+                # all in one step, as a backup made in several starts over whenever someone writes in between.
+                # in WAL mode this only holds a read snapshot, so writers carry on meanwhile
+                src.backup(dst)
+                result, = dst.execute("PRAGMA integrity_check").fetchone()
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"integrity check failed: {result}")
+            os.replace(tmp, f"backups/{num}.db")
+        except Exception:
+            os.remove(tmp)
+            logging.exception(f"failed to back up round {num}")
+            return
+    prune_backups()
+    logging.info(f"backed up round {num}")
+
+def prune_backups():
+    if not config.backups_kept:
+        return
+    nums = sorted(int(n) for name in os.listdir("backups") if (n := name.removesuffix(".db")).isdigit())
+    for num in nums[:-config.backups_kept]:
+        os.remove(f"backups/{num}.db")
+
+def backup(num):
+    threading.Thread(target=write_backup, args=(num,)).start()
+
+def write_public_db():
+    fd, tmp = tempfile.mkstemp(dir="static", suffix=".tmp")
+    os.close(fd)
+    try:
+        with contextlib.closing(connect()) as src, contextlib.closing(connect(tmp)) as public_db:
+            # in one step, like write_backup
+            src.backup(public_db)
+            with open("modify_for_public_viewing.sql") as f:
+                public_db.executescript(f.read())
+            # the public copy is meant to stand on its own
+            for hash, in public_db.execute("SELECT DISTINCT hash FROM Files WHERE hash IS NOT NULL").fetchall():
+                public_db.execute("UPDATE Files SET content = ? WHERE hash = ?", (blobs.get(hash), hash))
+            public_db.commit()
+        with open(tmp, "rb") as f, gzip.open(tmp + ".gz", "wb") as g:
+            shutil.copyfileobj(f, g)
+        os.replace(tmp + ".gz", "static/the.db.gz")
+        os.replace(tmp, "static/the.db")
+    except Exception:
+        for path in tmp, tmp + ".gz":
+            if os.path.exists(path):
+                os.remove(path)
+        logging.exception("failed to make public copy of the database")
+        return
+    logging.info("made public copy of the database")
 
 @app.route("/admin/<int:num>", methods=["POST"])
 def take_admin(num):
@@ -1116,16 +1943,24 @@ def take_admin(num):
     if not is_admin(user_id):
         flask.abort(403)
     form = flask.request.form
+    archives_stale = False
     try:
         db.execute("UPDATE Rounds SET spec = ? WHERE num = ?", (form["spec"], num))
-        db.execute("UPDATE Submissions SET cached_display = NULL WHERE round_num = ?", (num,))
+        # the previous round links to this one once it starts
+        db.execute("DELETE FROM RoundPages WHERE round_num IN (?, ?)", (num, num - 1))
         for key, value in form.items():
             # the pain of being str()'d
             if value == "None":
                 value = None 
             if value not in ADMIN_LANGUAGES:
                 continue
+            # archives hold what external files point to instead of the links, so only those changes show up in them
+            old = db.execute("SELECT lang FROM Files WHERE round_num = ? AND name = ?", (num, key)).fetchone()
+            if old and old[0] != value and (external_url(old[0]) or external_url(value)):
+                archives_stale = True
             db.execute("UPDATE Files SET lang = ? WHERE round_num = ? AND name = ?", (value, num, key))
+            if value == "archive":
+                index_archive(db, file_content(*db.execute("SELECT hash, content FROM Files WHERE round_num = ? AND name = ?", (num, key)).fetchone()))
 
         for timefield in "started_at", "stage2_at", "ended_at":
             date = form.get(timefield)
@@ -1146,13 +1981,16 @@ def take_admin(num):
                 for idx, sub in enumerate(subs, start=1):
                     author = sub["author_id"]
                     if config.canon_url:
-                        persona = requests.post(config.canon_url + f"/users/{author}/personas", json={"name": f"[{config.s}'s #{idx}]", "sudo": True, "temp": True}).json()["id"]
+                        name = f"[{config.s}'s #{idx}]"
+                        persona = canon.post(f"/users/{author}/personas", json={"name": name, "sudo": True, "temp": True}).json()["id"]
+                        persona_names[persona] = nh3.clean(name)
                     else:
                         persona = None
                     db.execute("UPDATE Submissions SET position = ?, persona = ? WHERE round_num = ? AND author_id = ?", (idx, persona, sub["round_num"], author))
                 db.commit()
                 logging.info(f"{user_id} moved round {num} to stage 2")
                 backup(num)
+                threading.Thread(target=prerender, args=([num],), daemon=True).start()
             case ("unstart round", 1):
                 db.execute("UPDATE Rounds SET stage = 0 WHERE num = ?", (num,))
                 logging.info(f"{user_id} unstarted round {num}")
@@ -1169,42 +2007,58 @@ def take_admin(num):
                 for idx, (so_called_winner,) in enumerate(winners):
                     if idx != winner_idx:
                         db.execute("UPDATE Submissions SET rank_override = ? WHERE round_num = ? AND author_id = ?", (2, num, so_called_winner))
+                store_scores(db, num)
+                index_totals(db, num)
 
                 db.commit()
                 logging.info(f"{user_id} ended round {num}")
                 backup(num)
+                build_archives(num)
 
-                # make public copy
-                shutil.copy("the.db", "static")
-                with open("modify_for_public_viewing.sql") as f:
-                    script = f.read()
-                public_db = connect("static/the.db")
-                public_db.executescript(script)
+                threading.Thread(target=write_public_db).start()
 
                 if config.canon_url:
-                    requests.post(config.canon_url + "/personas/purge")
+                    canon.post("/personas/purge")
+                    persona_names.clear()
+                    personas_changed(db)
             case (None, _):
+                renamed = set()
                 for key in form:
                     if not key.startswith("nix-"):
                         continue
                     pos = int(key.removeprefix("nix-"))
                     author, = db.execute("DELETE FROM Submissions WHERE round_num = ? AND position = ? RETURNING author_id", (num, pos)).fetchone()
+                    archives_stale = True
 
                     subs = db.execute("SELECT * FROM Submissions WHERE round_num = ? ORDER BY position", (num,)).fetchall()
                     db.execute("UPDATE Submissions SET position = NULL WHERE round_num = ?", (num,))
                     for idx, sub in enumerate(subs, start=1):
                         if config.canon_url and (persona := sub["persona"]):
-                            requests.patch(config.canon_url + f"/personas/{persona}", json={"name": f"[author of #{idx}]", "sudo": True})
+                            canon.patch(f"/personas/{persona}", json={"name": f"[author of #{idx}]", "sudo": True})
+                            persona_names.pop(persona)
+                            renamed.add(persona)
                         db.execute("UPDATE Submissions SET position = ? WHERE round_num = ? AND author_id = ?", (idx, sub["round_num"], sub["author_id"]))
 
+                    if rnd["stage"] == 3:
+                        store_scores(db, num)
+                        index_totals(db, num)
+
                     flask.flash(f"disqualified {author} ({get_name(author)})")
                     logging.info(f"{user_id} disqualified {author}")
+                if renamed:
+                    personas_changed(db, renamed)
             case _:
                 flask.abort(400)
     except:
         raise
     else:
+        if archives_stale:
+            archives_changed(db, num)
         db.commit()
+        if archives_stale:
+            drop_archives(num)
+            if rnd["stage"] == 3:
+                build_archives(num)
     finally:
         db.rollback()
         if exc := sys.exception():
@@ -1214,6 +2068,7 @@ def take_admin(num):
 @app.route("/callback")
 def callback():
     flask.session.permanent = True
+    flask.session.pop("identity", None)
     r = discord.callback()
     return flask.redirect(r["redirect"])
 
@@ -1224,8 +2079,14 @@ def login():
 @app.route("/logout")
 def logout():
     discord.revoke()
+    flask.session.pop("identity", None)
     return flask.redirect(flask.url_for("index"))
 
 @app.errorhandler(404)
 def not_found(e):
     return 'page not found :(<br><a href="/">go home</a>', 404
+
+@app.errorhandler(canon.Unavailable)
+def canon_unavailable(e):
+    logging.warning(str(e))
+    return 'canon isn\'t responding right now, so this can\'t be done. try again in a bit<br><a href="/">go home</a>', 503
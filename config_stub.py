@@ -14,6 +14,30 @@ log_file = None
 # Base URL to Canon server
 canon_url = None
 
+# Timeouts for requests to Canon in seconds, as (connect, read)
+canon_timeout = (3.05, 10)
+
+# How many connections to Canon each worker keeps open
+canon_pool_size = 10
+
+# After this many failed or slow (taking longer than canon_slow seconds) requests to Canon in a row,
+# stop contacting it for canon_breaker_cooldown seconds and show the last known answers instead
+canon_breaker_failures = 3
+canon_slow = 2
+canon_breaker_cooldown = 30
+
+# How long names of anonymous personas are remembered before asking Canon again, in seconds
+persona_ttl = 300
+
+# How long whether someone is an admin or allowed to play is remembered before asking Canon again, in seconds
+role_ttl = 60
+
+# How many of the most recent round backups (in backups/) to keep, or None to keep all of them
+backups_kept = 20
+
+# How many idle database connections each worker keeps open, for reading and for writing each
+db_pool_size = 4
+
 # Whether to cache the display of submissions (syntax highlighting, etc)
 # Should be True in production, as pygments is slow
 cache_display = True
@@ -1,5 +1,6 @@
 import datetime
 import sqlite3
+import threading
 
 def datetime_converter(value):
     return datetime.datetime.fromisoformat(value.decode())
@@ -10,8 +11,44 @@ def datetime_adapter(value):
 sqlite3.register_converter("timestamp", datetime_converter)
 sqlite3.register_adapter(datetime.datetime, datetime_adapter)
 
-def connect(path="the.db"):
-    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+def connect(path="the.db", readonly=False, check_same_thread=True):
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=check_same_thread)
     db.row_factory = sqlite3.Row
     db.execute("PRAGMA foreign_keys = ON")
+    # wait for whoever is writing instead of failing straight away
+    db.execute("PRAGMA busy_timeout = 5000")
+    # 32 MiB of page cache and up to 256 MiB mapped
+    db.execute("PRAGMA cache_size = -32768")
+    db.execute("PRAGMA mmap_size = 268435456")
+    # readers and the writer don't block each other in WAL mode, and with it NORMAL can't corrupt anything
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    if readonly:
+        db.execute("PRAGMA query_only = ON")
     return db
+
+# connections kept open between requests, so that each request doesn't have to open the database and warm its cache again
+class Pool:
+
+    def __init__(self, size, readonly=False):
+        self.size = size
+        self.readonly = readonly
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        # requests may be handled on a different thread each time
+        return connect(readonly=self.readonly, check_same_thread=False)
+
+    def put(self, db):
+        # don't hand a half-finished transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(db)
+                return
+        db.close()
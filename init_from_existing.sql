@@ -1,3 +1,5 @@
+-- for databases from before files were kept in blobs/, which still have their contents in Files.content.
+-- a database that already has Files.hash is on this schema already and can be used as it is
 ATTACH 'the.db' AS Other;
 
 INSERT INTO People (id, name)
@@ -6,8 +8,8 @@ INSERT INTO People (id, name)
 INSERT INTO Rounds (num, stage, spec, started_at, stage2_at, ended_at)
              SELECT num, stage, spec, started_at, stage2_at, ended_at
  FROM Other.Rounds;
-INSERT INTO Submissions (round_num, author_id, submitted_at, cached_display, position, persona, target, rank_override, bonus_given, finished_guessing)
-                  SELECT round_num, author_id, submitted_at, cached_display, position, persona, target, rank_override, bonus_given, finished_guessing
+INSERT INTO Submissions (round_num, author_id, submitted_at, position, persona, target, rank_override, bonus_given, finished_guessing)
+                  SELECT round_num, author_id, submitted_at, position, persona, target, rank_override, bonus_given, finished_guessing
  FROM Other.Submissions;
 INSERT INTO Files (round_num, author_id, name, lang, content)
             SELECT round_num, author_id, name, lang, content
@@ -21,3 +23,10 @@ INSERT INTO Likes (round_num, player_id, liked)
 INSERT INTO Comments (id, round_num, parent, author_id, content, unchanged_content, posted_at, edited_at, reply, persona, og_persona)
                SELECT id, round_num, parent, author_id, content, unchanged_content, posted_at, edited_at, reply, persona, og_persona
  FROM Other.Comments;
+INSERT INTO RoundScores (round_num, player_id, rank, total, plus, bonus, minus, won)
+                SELECT round_num, player_id, rank, total, plus, bonus, minus, won
+ FROM Scores INNER JOIN Rounds ON num = round_num WHERE stage = 3;
+INSERT INTO RunningTotals (round_num, player_id, total, plus, bonus, minus, played, won, likes)
+                  SELECT round_num, player_id, SUM(total) OVER w, SUM(plus) OVER w, SUM(bonus) OVER w, SUM(minus) OVER w, COUNT(*) OVER w, SUM(won) OVER w,
+                         SUM((SELECT COUNT(*) FROM Likes WHERE Likes.round_num = RoundScores.round_num AND liked = RoundScores.player_id)) OVER w
+ FROM RoundScores WINDOW w AS (PARTITION BY player_id ORDER BY round_num);
@@ -1,6 +1,10 @@
+PRAGMA journal_mode = DELETE;
 DROP TABLE Likes;
 DROP TABLE Comments;
-ALTER TABLE Submissions DROP COLUMN cached_display;
+DROP TABLE RoundPages;
+DROP TABLE Counters;
+DROP TABLE Displays;
+DROP TABLE ArchiveMembers;
 ALTER TABLE Submissions DROP COLUMN persona;
 ALTER TABLE Submissions DROP COLUMN finished_guessing;
 ALTER TABLE Guesses DROP COLUMN locked;
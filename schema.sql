@@ -16,7 +16,6 @@ CREATE TABLE Submissions (
     round_num INTEGER NOT NULL,
     author_id INTEGER NOT NULL,
     submitted_at TIMESTAMP,
-    cached_display TEXT,
     position INTEGER,
     persona INTEGER,
     target INTEGER,
@@ -37,7 +36,11 @@ CREATE TABLE Files (
     author_id INTEGER NOT NULL,
     name TEXT NOT NULL,
     lang TEXT,
-    content BLOB NOT NULL,
+    hash TEXT,
+    content BLOB,
+    filetype TEXT,
+    encoding TEXT,
+    text_length INTEGER,
     PRIMARY KEY (round_num, name),
     FOREIGN KEY (round_num, author_id) REFERENCES Submissions(round_num, author_id) ON DELETE CASCADE ON UPDATE CASCADE
 );
@@ -98,3 +101,60 @@ FROM (SELECT
     (SELECT COUNT(*) FROM Guesses WHERE guess = author_id AND guess = actual AND Guesses.round_num = Submissions.round_num) AS minus,
     rank_override
 FROM Submissions));
+
+CREATE TABLE RoundScores (
+    round_num INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    plus INTEGER NOT NULL,
+    bonus INTEGER NOT NULL,
+    minus INTEGER NOT NULL,
+    won INTEGER NOT NULL,
+    PRIMARY KEY (round_num, player_id),
+    FOREIGN KEY (round_num, player_id) REFERENCES Submissions(round_num, author_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE RunningTotals (
+    round_num INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    plus INTEGER NOT NULL,
+    bonus INTEGER NOT NULL,
+    minus INTEGER NOT NULL,
+    played INTEGER NOT NULL,
+    won INTEGER NOT NULL,
+    likes INTEGER NOT NULL,
+    PRIMARY KEY (player_id, round_num),
+    FOREIGN KEY (round_num, player_id) REFERENCES Submissions(round_num, author_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE RoundPages (
+    round_num INTEGER NOT NULL,
+    viewer TEXT NOT NULL,
+    version TEXT NOT NULL,
+    html TEXT NOT NULL,
+    PRIMARY KEY (round_num, viewer),
+    FOREIGN KEY (round_num) REFERENCES Rounds(num)
+);
+
+CREATE TABLE Displays (
+    key TEXT PRIMARY KEY,
+    html TEXT NOT NULL
+);
+
+CREATE TABLE ArchiveMembers (
+    archive TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT,
+    lang TEXT,
+    filetype TEXT,
+    encoding TEXT,
+    PRIMARY KEY (archive, name)
+);
+
+CREATE TABLE Counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
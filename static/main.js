@@ -238,3 +238,35 @@ function reply(id, parent) {
     if (reply) extra.removeChild(reply);
     extra.innerHTML += ` <span class="reply">replying to <a href="#c${id}">#${id}</a> ${unner}<input type="hidden" name="reply" value="${id}"></span>`
 }
+
+function loadFragment(elem) {
+    const src = elem.getAttribute("data-src");
+    if (!src) return;
+    elem.removeAttribute("data-src");
+    fetch(src).then(r => r.text()).then(html => {
+        elem.innerHTML = html;
+        watchFragments(elem);
+    });
+}
+
+const fragmentObserver = new IntersectionObserver((seen) => {
+    for (const entry of seen) {
+        if (!entry.isIntersecting) continue;
+        fragmentObserver.unobserve(entry.target);
+        loadFragment(entry.target);
+    }
+}, { rootMargin: "100% 0px" });
+
+function watchFragments(root) {
+    for (const elem of root.getElementsByClassName("fragment")) {
+        fragmentObserver.observe(elem);
+    }
+}
+
+watchFragments(document);
+document.addEventListener("toggle", (event) => {
+    if (!event.target.open) return;
+    for (const elem of event.target.children) {
+        if (elem.classList.contains("fragment")) loadFragment(elem);
+    }
+}, true);